@@ -1,9 +1,15 @@
 import asyncio
 import logging
-from datetime import datetime
-from typing import Optional
-
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+from cachetools import TTLCache
+from sqlalchemy import select, update, delete, and_, or_, desc, func, literal, union_all, bindparam
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import aliased, joinedload, raiseload
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -17,14 +23,18 @@ from telegram.ext import (
 from database import (
     init_db,
     async_session,
+    read_session,
     User,
     Chat,
     Message as ChatMessage,
     QueueEntry,
-    ChatHistory,
+    Role,
+    Problem,
 )
+from message_sender import send_later, start_senders, stop_senders
+from message_writer import save_message_later, start_writer, stop_writer
 from profanity_filter import check_profanity
-from config import BOT_TOKEN, MIN_AGE, MAX_AGE
+from config import CONFIG
 
 # Настройка логирования
 logging.basicConfig(
@@ -37,22 +47,270 @@ logger = logging.getLogger(__name__)
 WAITING_AGE, WAITING_ROLE, WAITING_PROBLEM = range(3)
 
 
+def _problem_keyboard(prefix: str) -> InlineKeyboardMarkup:
+    """Клавиатура выбора проблемы с заданным префиксом callback_data"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("1️⃣ Стресс и тревожность", callback_data=f"{prefix}stress_anxiety")],
+        [InlineKeyboardButton("2️⃣ Учеба", callback_data=f"{prefix}study")],
+        [InlineKeyboardButton("3️⃣ Друзья", callback_data=f"{prefix}friends")],
+    ])
+
+
+def parse_role(name: str) -> Role:
+    """Роль по имени из callback_data: support или receive (из role_receive_support)"""
+    return Role[name.upper()]
+
+
+def parse_problem(name: str) -> Problem:
+    """Проблема по имени из callback_data: stress_anxiety, study или friends"""
+    return Problem[name.upper()]
+
+
+# Клавиатуры не меняются, поэтому создаются один раз при импорте
+ROLE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1️⃣ Поддержать", callback_data="role_support")],
+    [InlineKeyboardButton("2️⃣ Получить поддержку", callback_data="role_receive_support")],
+])
+PROBLEM_KB = _problem_keyboard("problem_")
+MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 Найти собеседника", callback_data="find_match")],
+    [InlineKeyboardButton("📜 История чатов", callback_data="chat_history")],
+    [InlineKeyboardButton("❌ Завершить текущий чат", callback_data="end_chat")],
+])
+MENU_ROLE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1️⃣ Поддержать", callback_data="menu_role_support")],
+    [InlineKeyboardButton("2️⃣ Получить поддержку", callback_data="menu_role_receive_support")],
+])
+MENU_PROBLEM_KB = {
+    role: _problem_keyboard(f"menu_problem_{role.name.lower()}_")
+    for role in Role
+}
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")
+BACK_TO_HISTORY_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="chat_history")]])
+
+# Уведомление о найденном собеседнике
+_NOTIFY_TMPL = (
+    "✅ Собеседник найден!\n\n"
+    "Возраст собеседника: {other_age} лет\n"
+    "Ваш возраст виден собеседнику: {self_age} лет\n\n"
+    "Начните общение!"
+)
+
+
+class CachedUser(NamedTuple):
+    """Снимок пользователя, не привязанный к сессии"""
+    id: int
+    age: int
+    is_banned: bool
+    current_chat_id: Optional[int]
+    partner_telegram_id: Optional[int]
+
+
+# Кэш пользователей по telegram_id (сбрасывается при изменении бана или чата)
+user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# Загрузки пользователей, идущие прямо сейчас: telegram_id -> [число загрузок, поколение].
+# Сброс увеличивает поколение, и загрузка, во время которой пользователя сбросили,
+# не попадает в кэш. Запись удаляется после последней загрузки, так что словарь не растет
+_pending_loads: dict[int, list[int]] = {}
+
+
+async def get_user_cached(session, telegram_id: int) -> Optional[CachedUser]:
+    """Возвращает пользователя из кэша, при промахе загружает его из базы"""
+    cached = user_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+
+    pending = _pending_loads.setdefault(telegram_id, [0, 0])
+    pending[0] += 1
+    generation = pending[1]
+    try:
+        result = await session.execute(_Q_USER_BY_TG, {'tg': telegram_id})
+        user = result.scalar_one_or_none()
+    finally:
+        pending[0] -= 1
+        if not pending[0]:
+            del _pending_loads[telegram_id]
+
+    if not user:
+        return None
+
+    cached = CachedUser(user.id, user.age, user.is_banned, user.current_chat_id, user.partner_telegram_id)
+    # Пока шел запрос, другая задача могла закоммитить изменения и сбросить кэш:
+    # тогда загруженная строка уже устарела и сохранять ее нельзя
+    if pending[1] == generation:
+        user_cache[telegram_id] = cached
+    return cached
+
+
+def invalidate_user_cache(*telegram_ids: int):
+    """Удаляет пользователей из кэша (вызывается после коммита изменений)"""
+    for telegram_id in telegram_ids:
+        pending = _pending_loads.get(telegram_id)
+        if pending is not None:
+            pending[1] += 1
+        user_cache.pop(telegram_id, None)
+
+
+def mark_user_stale(session, *telegram_ids: int):
+    """Помечает пользователей для сброса кэша после коммита транзакции unit_of_work"""
+    session.info.setdefault('stale_users', set()).update(telegram_ids)
+
+
+# Сигнал фоновому подбору о том, что в очереди появились новые записи
+matchmaking_signal = asyncio.Event()
+# Страховочный интервал подбора (в секундах), если сигнал не пришел
+MATCHMAKING_WATCHDOG = 30
+# Сколько пар забирается за одну транзакцию подбора; остальные - в следующем проходе
+MATCHMAKING_BATCH_SIZE = 500
+_matchmaker_tasks: list[asyncio.Task] = []
+
+
+def mark_queue_changed(session):
+    """Запускает подбор после коммита транзакции unit_of_work (запись в очереди уже видна)"""
+    session.info['queue_changed'] = True
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Открывает сессию с одной транзакцией на весь обработчик.
+    Коммит выполняется один раз при выходе из блока, после него сбрасывается кэш
+    пользователей, отмеченных через mark_user_stale, и при необходимости
+    запускается подбор (mark_queue_changed).
+    """
+    async with async_session() as session:
+        async with session.begin():
+            yield session
+        invalidate_user_cache(*session.info.get('stale_users', ()))
+        if session.info.get('queue_changed'):
+            matchmaking_signal.set()
+
+
+# Диапазоны возрастов собеседников для каждого возраста пользователя
+_AGE_TABLE = {
+    14: (14, 16),
+    15: (14, 17),
+    16: (14, 18),
+    17: (15, 18),
+    18: (16, 18),
+}
+
+
 def get_age_range(user_age: int) -> tuple[int, int]:
     """
     Возвращает диапазон возрастов для подбора собеседников в зависимости от возраста пользователя.
     """
-    if user_age == 14:
-        return (14, 16)
-    elif user_age == 15:
-        return (14, 17)
-    elif user_age == 16:
-        return (14, 18)
-    elif user_age == 17:
-        return (15, 18)
-    elif user_age == 18:
-        return (16, 18)
-    else:
-        return (MIN_AGE, MAX_AGE)
+    return _AGE_TABLE.get(user_age, (CONFIG.MIN_AGE, CONFIG.MAX_AGE))
+
+
+def _build_queue_pairs_query():
+    """Строит запрос, возвращающий все подходящие пары (user1_id, user2_id) из очереди"""
+    # Таблица допустимых возрастов собеседника, построенная по get_age_range
+    age_rows = []
+    for age in range(CONFIG.MIN_AGE, CONFIG.MAX_AGE + 1):
+        min_age, max_age = get_age_range(age)
+        age_rows.append(
+            select(literal(age).label('age'), literal(min_age).label('min_age'), literal(max_age).label('max_age'))
+        )
+    age_ranges = union_all(*age_rows).cte('age_ranges')
+
+    entry1, entry2 = aliased(QueueEntry), aliased(QueueEntry)
+    user1, user2 = aliased(User), aliased(User)
+    range1, range2 = age_ranges.alias('range1'), age_ranges.alias('range2')
+
+    return (
+        select(entry1.user_id.label('user1_id'), entry2.user_id.label('user2_id'))
+        .join(user1, entry1.user_id == user1.id)
+        # Роли закреплены (первый поддерживает, второй получает поддержку): каждая пара
+        # находится один раз, а entry2 ищется по индексу ix_queue_match (problem_type, role, age)
+        .join(entry2, and_(
+            entry2.problem_type == entry1.problem_type,
+            entry2.role == Role.RECEIVE
+        ))
+        .join(user2, entry2.user_id == user2.id)
+        .join(range1, range1.c.age == entry1.age)
+        .join(range2, range2.c.age == entry2.age)
+        .where(
+            entry1.role == Role.SUPPORT,
+            # Возраст берется из очереди, чтобы условия покрывались индексом ix_queue_match
+            entry2.age.between(range1.c.min_age, range1.c.max_age),
+            entry1.age.between(range2.c.min_age, range2.c.max_age),
+            user1.is_banned.is_(False),
+            user2.is_banned.is_(False),
+            user1.current_chat_id.is_(None),
+            user2.current_chat_id.is_(None)
+        )
+        .order_by(func.min(entry1.joined_at, entry2.joined_at), func.max(entry1.joined_at, entry2.joined_at))
+    )
+
+
+def _build_upsert(model, index_elements, update_columns):
+    """Строит INSERT ... ON CONFLICT DO UPDATE, значения строки передаются при выполнении"""
+    stmt = insert(model)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: stmt.excluded[name] for name in update_columns}
+    )
+
+
+# Часто выполняемые запросы строятся один раз, значения передаются через bindparam.
+# Скомпилированный SQL для них берется из кэша движка (query_cache_size)
+_Q_USER_BY_TG = select(User).where(User.telegram_id == bindparam('tg'))
+_Q_FIND_MATCH = (
+    select(QueueEntry, User).join(User, QueueEntry.user_id == User.id).where(  # type: ignore
+        and_(
+            QueueEntry.user_id != bindparam('user_id'),
+            QueueEntry.role == bindparam('role'),
+            QueueEntry.problem_type == bindparam('problem'),
+            QueueEntry.age >= bindparam('min_age'),
+            QueueEntry.age <= bindparam('max_age'),
+            User.is_banned.is_(False),  # Используем .is_() для правильного типа
+            User.current_chat_id.is_(None)
+        )
+    ).order_by(QueueEntry.joined_at).options(raiseload('*'))
+)
+# Все подходящие пары в порядке ожидания
+_Q_QUEUE_PAIRS = _build_queue_pairs_query()
+# Любая подходящая пара: без сортировки запрос останавливается на первой найденной
+_Q_ANY_QUEUE_PAIR = _Q_QUEUE_PAIRS.order_by(None).limit(1)
+# Забирает из очереди записи обоих участников пары и возвращает их.
+# Записи удаляются, только если в очереди есть обе: пара забирается целиком или никак
+_claim_ids = bindparam('user_ids', expanding=True)
+_Q_CLAIM_QUEUE_PAIR = (
+    delete(QueueEntry)
+    .where(
+        QueueEntry.user_id.in_(_claim_ids),  # type: ignore
+        select(func.count()).where(QueueEntry.user_id.in_(_claim_ids)).scalar_subquery() == 2  # type: ignore
+    )
+    .returning(QueueEntry.user_id, QueueEntry.role, QueueEntry.problem_type)
+    .execution_options(synchronize_session=False)
+)
+_Q_USERS_BY_IDS = select(User).where(User.id.in_(bindparam('user_ids', expanding=True)))  # type: ignore
+# Последние 3 завершенных чата пользователя
+_Q_CHAT_HISTORY = (
+    select(Chat).where(
+        or_(Chat.user1_id == bindparam('user_id'), Chat.user2_id == bindparam('user_id')),  # type: ignore
+        Chat.ended_at.isnot(None)
+    )
+    .order_by(desc(Chat.ended_at))
+    .limit(3)
+)
+# Загрузка чата сразу с обоими участниками (один SELECT с JOIN)
+_CHAT_WITH_USERS = [joinedload(Chat.user1), joinedload(Chat.user2)]
+_Q_ENQUEUE = _build_upsert(QueueEntry, [QueueEntry.user_id], ('role', 'problem_type', 'age', 'joined_at'))
+# Удаление из очереди заблокированных и уже общающихся пользователей
+_Q_PURGE_QUEUE = delete(QueueEntry).where(QueueEntry.user_id.in_(  # type: ignore
+    select(User.id).where(or_(User.is_banned.is_(True), User.current_chat_id.isnot(None)))
+))
+_Q_INSERT_CHATS = insert(Chat).returning(Chat.id, sort_by_parameter_order=True)
+_Q_UPDATE_USERS = update(User)
+_Q_CHAT_MESSAGES = (
+    select(ChatMessage).where(ChatMessage.chat_id == bindparam('chat_id'))  # type: ignore
+    .order_by(ChatMessage.sent_at)
+)
+_Q_REMOVE_FROM_QUEUE = delete(QueueEntry).where(
+    QueueEntry.user_id.in_(bindparam('user_ids', expanding=True))  # type: ignore
+)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -61,9 +319,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     async with async_session() as session:
         # Проверяем, зарегистрирован ли пользователь
-        from sqlalchemy import select
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
+        user = await get_user_cached(session, user_id)
 
         if user:
             if user.is_banned:
@@ -89,7 +345,7 @@ async def handle_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         age = int(update.message.text)
 
-        if age < MIN_AGE or age > MAX_AGE:
+        if age < CONFIG.MIN_AGE or age > CONFIG.MAX_AGE:
             await update.message.reply_text(
                 "⚠️ Данным ботом могут пользоваться лишь пользователи, достигшие возраста 14 лет и не старше 18 лет."
             )
@@ -104,25 +360,20 @@ async def handle_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             user = User(
                 telegram_id=user_id,
                 age=age,
-                is_banned=False,
-                registered_at=datetime.utcnow()
+                is_banned=False
             )
             session.add(user)
-            await session.commit()
-            await session.refresh(user)
+            # flush получает id из INSERT, повторный SELECT не нужен
+            await session.flush()
             context.user_data['user_id'] = user.id
+            await session.commit()
+        invalidate_user_cache(user_id)
 
         # Показываем выбор роли
-        keyboard = [
-            [InlineKeyboardButton("1️⃣ Поддержать", callback_data="role_support")],
-            [InlineKeyboardButton("2️⃣ Получить поддержку", callback_data="role_receive_support")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await update.message.reply_text(
             "✅ Регистрация завершена!\n\n"
             "Выберите категорию действий:",
-            reply_markup=reply_markup
+            reply_markup=ROLE_KB
         )
 
         return WAITING_ROLE
@@ -139,20 +390,13 @@ async def handle_role_selection(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
 
-    role = query.data.split("_")[1]  # support или receive_support
+    role = parse_role(query.data.split("_")[1])  # support или receive
     context.user_data['role'] = role
 
     # Показываем выбор проблемы
-    keyboard = [
-        [InlineKeyboardButton("1️⃣ Стресс и тревожность", callback_data="problem_stress_anxiety")],
-        [InlineKeyboardButton("2️⃣ Учеба", callback_data="problem_study")],
-        [InlineKeyboardButton("3️⃣ Друзья", callback_data="problem_friends")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         "Выберите проблему:",
-        reply_markup=reply_markup
+        reply_markup=PROBLEM_KB
     )
 
     return WAITING_PROBLEM
@@ -163,14 +407,13 @@ async def handle_problem_selection(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
 
-    problem = "_".join(query.data.split("_")[1:])  # stress_anxiety, study, friends
+    problem = parse_problem("_".join(query.data.split("_")[1:]))  # stress_anxiety, study, friends
     context.user_data['problem'] = problem
 
     user_id = update.effective_user.id
 
-    async with async_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
+    async with unit_of_work() as session:
+        result = await session.execute(_Q_USER_BY_TG, {'tg': user_id})
         user = result.scalar_one_or_none()
 
         if not user:
@@ -180,113 +423,84 @@ async def handle_problem_selection(update: Update, context: ContextTypes.DEFAULT
         # Обновляем информацию о пользователе
         user.current_role = context.user_data['role']
         user.current_problem = problem
-        await session.commit()
 
         # Добавляем пользователя в очередь
         await add_to_queue(session, user, context.user_data['role'], problem)
 
-        await query.edit_message_text(
-            "🔍 Ищем подходящего собеседника...\n"
-            "Пожалуйста, подождите."
-        )
-
         # Пытаемся найти собеседника
         match = await find_match(session, user, context.user_data['role'], problem)
 
         if match:
             # Создаем чат
             chat = await create_chat(session, user, match, context.user_data['role'], problem)
-            await session.commit()
+            mark_user_stale(session, user.telegram_id, match.telegram_id)
 
             # Удаляем обоих из очереди
-            await remove_from_queue(session, user.id)
-            await remove_from_queue(session, match.id)
+            await remove_from_queue_bulk(session, [user.id, match.id])
 
-            # Отправляем сообщения обоим пользователям
-            await context.bot.send_message(
-                chat_id=user.telegram_id,
-                text=f"✅ Собеседник найден!\n\n"
-                     f"Возраст собеседника: {match.age} лет\n"
-                     f"Ваш возраст виден собеседнику: {user.age} лет\n\n"
-                     f"Начните общение!"
-            )
+    # Уведомления отправляем после коммита, не удерживая транзакцию
+    await query.edit_message_text(
+        "🔍 Ищем подходящего собеседника...\n"
+        "Пожалуйста, подождите."
+    )
 
-            await context.bot.send_message(
-                chat_id=match.telegram_id,
-                text=f"✅ Собеседник найден!\n\n"
-                     f"Возраст собеседника: {user.age} лет\n"
-                     f"Ваш возраст виден собеседнику: {match.age} лет\n\n"
-                     f"Начните общение!"
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=user.telegram_id,
-                text="⏳ Собеседник пока не найден. Вы добавлены в очередь ожидания.\n"
-                     "Мы уведомим вас, когда найдем подходящего собеседника."
-            )
+    if match:
+        # Отправляем уведомления обоим пользователям
+        await send_later(
+            chat_id=user.telegram_id,
+            text=_NOTIFY_TMPL.format_map({'other_age': match.age, 'self_age': user.age})
+        )
+        await send_later(
+            chat_id=match.telegram_id,
+            text=_NOTIFY_TMPL.format_map({'other_age': user.age, 'self_age': match.age})
+        )
+    else:
+        await send_later(
+            chat_id=user.telegram_id,
+            text="⏳ Собеседник пока не найден. Вы добавлены в очередь ожидания.\n"
+                 "Мы уведомим вас, когда найдем подходящего собеседника."
+        )
 
     return ConversationHandler.END
 
 
-async def add_to_queue(session, user: User, role: str, problem: str):
-    """Добавляет пользователя в очередь"""
-    # Проверяем, не находится ли пользователь уже в очереди
-    from sqlalchemy import select
-    result = await session.execute(
-        select(QueueEntry).where(QueueEntry.user_id == user.id)  # type: ignore
-    )
-    existing = result.scalar_one_or_none()
-
-    if existing:
-        # Обновляем существующую запись
-        existing.role = role
-        existing.problem_type = problem
-        existing.age = user.age
-        existing.joined_at = datetime.utcnow()
-    else:
-        # Создаем новую запись
-        queue_entry = QueueEntry(
-            user_id=user.id,
-            role=role,
-            problem_type=problem,
-            age=user.age,
-            joined_at=datetime.utcnow()
-        )
-        session.add(queue_entry)
+async def add_to_queue(session, user: User, role: Role, problem: Problem):
+    """
+    Добавляет пользователя в очередь.
+    Если пользователь уже в очереди, его запись обновляется тем же запросом (upsert).
+    """
 
-    await session.commit()
+    await session.execute(_Q_ENQUEUE, {
+        'user_id': user.id,
+        'role': role,
+        'problem_type': problem,
+        'age': user.age,
+        'joined_at': datetime.now(timezone.utc),
+    })
+    mark_queue_changed(session)
 
 
-async def remove_from_queue(session, user_id: int):
-    """Удаляет пользователя из очереди"""
-    from sqlalchemy import delete
-    await session.execute(delete(QueueEntry).where(QueueEntry.user_id == user_id))  # type: ignore
-    await session.commit()
+async def remove_from_queue_bulk(session, user_ids: list[int]):
+    """Удаляет пользователей из очереди одним запросом"""
+    await session.execute(_Q_REMOVE_FROM_QUEUE, {'user_ids': user_ids})
 
 
-async def find_match(session, user: User, role: str, problem: str) -> Optional[User]:
+async def find_match(session, user: User, role: Role, problem: Problem) -> Optional[User]:
     """Ищет подходящего собеседника"""
     # Определяем противоположную роль
-    opposite_role = "receive_support" if role == "support" else "support"
+    opposite_role = role.opposite
 
     # Получаем диапазон возрастов для пользователя
     min_age, max_age = get_age_range(user.age)
 
     # Ищем подходящего собеседника в очереди
-    from sqlalchemy import select, and_
-    result = await session.execute(
-        select(QueueEntry, User).join(User, QueueEntry.user_id == User.id).where(  # type: ignore
-            and_(
-                QueueEntry.user_id != user.id,
-                QueueEntry.role == opposite_role,
-                QueueEntry.problem_type == problem,
-                User.age >= min_age,
-                User.age <= max_age,
-                User.is_banned.is_(False),  # Используем .is_() для правильного типа
-                User.current_chat_id.is_(None)
-            )
-        ).order_by(QueueEntry.joined_at)
-    )
+    result = await session.execute(_Q_FIND_MATCH, {
+        'user_id': user.id,
+        'role': opposite_role,
+        'problem': problem,
+        'min_age': min_age,
+        'max_age': max_age,
+    })
 
     match_entry = result.first()
 
@@ -301,17 +515,54 @@ async def find_match(session, user: User, role: str, problem: str) -> Optional[U
     return None
 
 
-async def create_chat(session, user1: User, user2: User, role1: str, problem: str) -> Chat:
-    """Создает чат между двумя пользователями"""
-    role2 = "receive_support" if role1 == "support" else "support"
+async def has_queue_pair(session) -> bool:
+    """Проверяет, есть ли в очереди хотя бы одна подходящая пара"""
+    result = await session.execute(_Q_ANY_QUEUE_PAIR)
+    return result.first() is not None
+
+
+async def select_queue_pairs(session, limit: int) -> list[tuple[int, int]]:
+    """
+    Выбирает из очереди непересекающиеся пары (user1_id, user2_id), не больше limit.
+    Запрос всех пар выполняется один раз, пары берутся жадно в порядке ожидания:
+    пара пропускается, если один из участников уже попал в выбранную ранее.
+    """
+    result = await session.execute(_Q_QUEUE_PAIRS)
+
+    pairs = []
+    taken = set()
+    for user1_id, user2_id in result:
+        if user1_id in taken or user2_id in taken:
+            continue
+        pairs.append((user1_id, user2_id))
+        taken.update((user1_id, user2_id))
+        if len(pairs) >= limit:
+            break
+
+    return pairs
+
+
+async def claim_queue_pair(session, user1_id: int, user2_id: int) -> list:
+    """
+    Забирает пару из очереди одним запросом DELETE ... RETURNING.
+    Возвращает строки (user_id, role, problem_type) в порядке участников пары
+    или пустой список, если хотя бы одного из них в очереди уже нет.
+    """
+    result = await session.execute(_Q_CLAIM_QUEUE_PAIR, {'user_ids': [user1_id, user2_id]})
+    entries = {entry.user_id: entry for entry in result}
+    if len(entries) != 2:
+        return []
+    return [entries[user1_id], entries[user2_id]]
 
+
+async def create_chat(session, user1: User, user2: User, role1: Role, problem: Problem) -> Chat:
+    """Создает чат между двумя пользователями"""
     chat = Chat(
         user1_id=user1.id,
         user2_id=user2.id,
         role1=role1,
-        role2=role2,
+        role2=role1.opposite,
         problem_type=problem,
-        created_at=datetime.utcnow(),
         is_active=True
     )
     session.add(chat)
@@ -320,19 +571,42 @@ async def create_chat(session, user1: User, user2: User, role1: str, problem: st
     # Обновляем информацию о текущем чате у пользователей
     user1.current_chat_id = chat.id
     user2.current_chat_id = chat.id
+    user1.partner_telegram_id = user2.telegram_id
+    user2.partner_telegram_id = user1.telegram_id
 
     return chat
 
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
-    """Показывает главное меню"""
-    keyboard = [
-        [InlineKeyboardButton("💬 Найти собеседника", callback_data="find_match")],
-        [InlineKeyboardButton("📜 История чатов", callback_data="chat_history")],
-        [InlineKeyboardButton("❌ Завершить текущий чат", callback_data="end_chat")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def create_chats_bulk(session, pairs):
+    """
+    Создает чаты для списка пар (user1, user2, role1, problem):
+    один INSERT для всех чатов и один UPDATE для всех пользователей
+    """
+    result = await session.execute(
+        _Q_INSERT_CHATS,
+        [
+            {
+                'user1_id': user1.id,
+                'user2_id': user2.id,
+                'role1': role1,
+                'role2': role1.opposite,
+                'problem_type': problem,
+                'is_active': True,
+            }
+            for user1, user2, role1, problem in pairs
+        ]
+    )
 
+    # Обновляем информацию о текущем чате у пользователей (UPDATE по первичному ключу)
+    user_rows = []
+    for chat_id, (user1, user2, _, _) in zip(result.scalars(), pairs):
+        user_rows.append({'id': user1.id, 'current_chat_id': chat_id, 'partner_telegram_id': user2.telegram_id})
+        user_rows.append({'id': user2.id, 'current_chat_id': chat_id, 'partner_telegram_id': user1.telegram_id})
+    await session.execute(_Q_UPDATE_USERS, user_rows)
+
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user: CachedUser):
+    """Показывает главное меню"""
     text = "Главное меню:\n\n"
     if user.current_chat_id:
         text += "✅ У вас есть активный чат"
@@ -340,9 +614,9 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, use
         text += "❌ У вас нет активного чата"
 
     if update.message:
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.message.reply_text(text, reply_markup=MENU_KB)
     elif update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+        await update.callback_query.edit_message_text(text, reply_markup=MENU_KB)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -350,10 +624,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     message_text = update.message.text
 
-    async with async_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
+    partner_telegram_id = None
+    chat_user = None
+
+    async with unit_of_work() as session:
+        user = await get_user_cached(session, user_id)
 
         if not user:
             await update.message.reply_text("Пожалуйста, начните с команды /start")
@@ -366,8 +641,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Проверка на ненормативную лексику
         if check_profanity(message_text):
             # Блокируем пользователя
-            user.is_banned = True
-            await session.commit()
+            db_user = await session.get(User, user.id)
+            db_user.is_banned = True
+            mark_user_stale(session, user_id)
 
             await update.message.reply_text(
                 "❌ Вы использовали ненормативную лексику. "
@@ -375,47 +651,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        # Если у пользователя есть активный чат, пересылаем сообщение
-        if user.current_chat_id:
-            chat_id = user.current_chat_id
-            result = await session.execute(select(Chat).where(Chat.id == chat_id))  # type: ignore
-            chat = result.scalar_one_or_none()
-
-            if chat and chat.is_active:
-                # Определяем собеседника
-                if chat.user1_id == user.id:
-                    partner_id = chat.user2_id
-                else:
-                    partner_id = chat.user1_id
-
-                result = await session.execute(select(User).where(User.id == partner_id))  # type: ignore
-                partner = result.scalar_one_or_none()
-
-                if partner:
-                    # Сохраняем сообщение в базу
-                    message = ChatMessage(
-                        chat_id=chat.id,
-                        user_id=user.id,
-                        text=message_text,
-                        sent_at=datetime.utcnow()
-                    )
-                    session.add(message)
-                    await session.commit()
-
-                    # Отправляем сообщение собеседнику
-                    await context.bot.send_message(
-                        chat_id=partner.telegram_id,
-                        text=message_text
-                    )
-                else:
-                    await update.message.reply_text("❌ Собеседник не найден.")
-            else:
-                await update.message.reply_text("❌ Чат не активен.")
+        # Если у пользователя есть активный чат, пересылаем сообщение.
+        # Собеседник хранится у пользователя, поэтому чат загружать не нужно
+        if user.current_chat_id and user.partner_telegram_id:
+            partner_telegram_id = user.partner_telegram_id
+            chat_user = user
         else:
             await update.message.reply_text(
                 "У вас нет активного чата. Используйте /start для поиска собеседника."
             )
 
+    if partner_telegram_id:
+        # Сообщение записывается в базу фоновой задачей пачками вместе с другими
+        await save_message_later(
+            chat_id=chat_user.current_chat_id,
+            user_id=chat_user.id,
+            text=message_text,
+            # Значение по умолчанию в БД точно только до секунды, а порядок сообщений важен
+            sent_at=datetime.now(timezone.utc)
+        )
+        await send_later(
+            chat_id=partner_telegram_id,
+            text=message_text
+        )
+
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback-запросов"""
@@ -424,10 +683,14 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.effective_user.id
 
-    async with async_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
+    # Результаты изменений, о которых сообщаем после коммита
+    queued_user = None
+    match = None
+    chat_ended = False
+    partner_telegram_id = None
+
+    async with unit_of_work() as session:
+        user = await get_user_cached(session, user_id)
 
         if not user or user.is_banned:
             await query.edit_message_text("❌ Доступ запрещен.")
@@ -435,181 +698,67 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if query.data == "find_match":
             # Показываем выбор роли
-            keyboard = [
-                [InlineKeyboardButton("1️⃣ Поддержать", callback_data="menu_role_support")],
-                [InlineKeyboardButton("2️⃣ Получить поддержку", callback_data="menu_role_receive_support")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите категорию действий:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите категорию действий:", reply_markup=MENU_ROLE_KB)
 
         elif query.data.startswith("menu_role_"):
-            role = query.data.split("_")[2]
+            role = parse_role(query.data.split("_")[2])
             context.user_data['role'] = role
 
-            keyboard = [
-                [InlineKeyboardButton("1️⃣ Стресс и тревожность", callback_data=f"menu_problem_{role}_stress_anxiety")],
-                [InlineKeyboardButton("2️⃣ Учеба", callback_data=f"menu_problem_{role}_study")],
-                [InlineKeyboardButton("3️⃣ Друзья", callback_data=f"menu_problem_{role}_friends")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите проблему:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите проблему:", reply_markup=MENU_PROBLEM_KB[role])
 
         elif query.data.startswith("menu_problem_"):
             parts = query.data.split("_")
-            role = parts[2]
-            problem = "_".join(parts[3:])  # stress_anxiety, study, friends
+            role = parse_role(parts[2])
+            problem = parse_problem("_".join(parts[3:]))  # stress_anxiety, study, friends
 
+            # Для изменений нужен объект пользователя из текущей сессии
+            user = await session.get(User, user.id)
             user.current_role = role
             user.current_problem = problem
-            await session.commit()
 
             await add_to_queue(session, user, role, problem)
-
-            await query.edit_message_text(
-                "🔍 Ищем подходящего собеседника...\n"
-                "Пожалуйста, подождите."
-            )
+            queued_user = user
 
             # Пытаемся найти собеседника
             match = await find_match(session, user, role, problem)
 
             if match:
-                chat = await create_chat(session, user, match, role, problem)
-                await session.commit()
-
-                await remove_from_queue(session, user.id)
-                await remove_from_queue(session, match.id)
-
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=f"✅ Собеседник найден!\n\n"
-                         f"Возраст собеседника: {match.age} лет\n"
-                         f"Ваш возраст виден собеседнику: {user.age} лет\n\n"
-                         f"Начните общение!"
-                )
+                await create_chat(session, user, match, role, problem)
+                mark_user_stale(session, user.telegram_id, match.telegram_id)
 
-                await context.bot.send_message(
-                    chat_id=match.telegram_id,
-                    text=f"✅ Собеседник найден!\n\n"
-                         f"Возраст собеседника: {user.age} лет\n"
-                         f"Ваш возраст виден собеседнику: {match.age} лет\n\n"
-                         f"Начните общение!"
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text="⏳ Собеседник пока не найден. Вы добавлены в очередь ожидания.\n"
-                         "Мы уведомим вас, когда найдем подходящего собеседника."
-                )
+                await remove_from_queue_bulk(session, [user.id, match.id])
 
         elif query.data == "chat_history":
             await show_chat_history(query, session, user, context)
 
         elif query.data == "end_chat":
             if user.current_chat_id:
-                result = await session.execute(select(Chat).where(Chat.id == user.current_chat_id))  # type: ignore
-                chat = result.scalar_one_or_none()
+                chat = await session.get(Chat, user.current_chat_id, options=_CHAT_WITH_USERS)
 
                 if chat:
+                    # Время завершения задает порядок чатов в истории
                     chat.is_active = False
-                    chat.ended_at = datetime.utcnow()
+                    chat.ended_at = datetime.now(timezone.utc)
 
-                    # Определяем собеседника
+                    # Оба участника загружены вместе с чатом
                     if chat.user1_id == user.id:
-                        partner_id = chat.user2_id
+                        user, partner = chat.user1, chat.user2
                     else:
-                        partner_id = chat.user1_id
-
-                    result = await session.execute(select(User).where(User.id == partner_id))  # type: ignore
-                    partner = result.scalar_one_or_none()
+                        user, partner = chat.user2, chat.user1
 
                     if partner:
                         partner.current_chat_id = None
-                        await context.bot.send_message(
-                            chat_id=partner.telegram_id,
-                            text="❌ Собеседник завершил чат."
-                        )
+                        partner.partner_telegram_id = None
 
                     user.current_chat_id = None
+                    user.partner_telegram_id = None
 
-                    # Сохраняем историю чата для обоих пользователей
-                    # Проверяем, не превышает ли количество сохраненных чатов 3
-                    from sqlalchemy import select, desc, and_, func
-
-                    # Для текущего пользователя
-                    # Проверяем, не существует ли уже запись для этого чата
-                    result = await session.execute(
-                        select(ChatHistory).where(
-                            and_(ChatHistory.user_id == user.id, ChatHistory.chat_id == chat.id)
-                        )
-                    )
-                    existing_entry = result.scalar_one_or_none()
-
-                    if not existing_entry:
-                        result = await session.execute(
-                            select(func.count(ChatHistory.id)).where(ChatHistory.user_id == user.id)  # type: ignore
-                        )
-                        user_history_count = result.scalar()
-
-                        if user_history_count >= 3:
-                            # Удаляем самую старую запись
-                            result = await session.execute(
-                                select(ChatHistory).where(ChatHistory.user_id == user.id)  # type: ignore
-                                .order_by(ChatHistory.viewed_at).limit(1)
-                            )
-                            old_entry = result.scalar_one_or_none()
-                            if old_entry:
-                                session.delete(old_entry)
-
-                        history_entry = ChatHistory(
-                            user_id=user.id,
-                            chat_id=chat.id,
-                            viewed_at=datetime.utcnow()
-                        )
-                        session.add(history_entry)
-                    else:
-                        # Обновляем время просмотра
-                        existing_entry.viewed_at = datetime.utcnow()
-
-                    # Для собеседника
+                    mark_user_stale(session, user.telegram_id)
                     if partner:
-                        result = await session.execute(
-                            select(ChatHistory).where(
-                                and_(ChatHistory.user_id == partner.id, ChatHistory.chat_id == chat.id)
-                            )
-                        )
-                        existing_entry = result.scalar_one_or_none()
-
-                        if not existing_entry:
-                            result = await session.execute(
-                                select(func.count(ChatHistory.id)).where(ChatHistory.user_id == partner.id)  # type: ignore
-                                # type: ignore
-                            )
-                            partner_history_count = result.scalar()
-
-                            if partner_history_count >= 3:
-                                # Удаляем самую старую запись
-                                result = await session.execute(
-                                    select(ChatHistory).where(ChatHistory.user_id == partner.id)  # type: ignore
-                                    .order_by(ChatHistory.viewed_at).limit(1)
-                                )
-                                old_entry = result.scalar_one_or_none()
-                                if old_entry:
-                                    session.delete(old_entry)
-
-                            history_entry = ChatHistory(
-                                user_id=partner.id,
-                                chat_id=chat.id,
-                                viewed_at=datetime.utcnow()
-                            )
-                            session.add(history_entry)
-                        else:
-                            # Обновляем время просмотра
-                            existing_entry.viewed_at = datetime.utcnow()
-
-                    await session.commit()
-
-                    await query.edit_message_text("✅ Чат завершен.")
+                        mark_user_stale(session, partner.telegram_id)
+                        partner_telegram_id = partner.telegram_id
+
+                    chat_ended = True
                 else:
                     await query.edit_message_text("❌ Чат не найден.")
             else:
@@ -622,34 +771,60 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif query.data == "back_to_menu":
             await show_main_menu(update, context, user)
 
+    # Уведомления отправляем после коммита, не удерживая транзакцию
+    if queued_user:
+        await query.edit_message_text(
+            "🔍 Ищем подходящего собеседника...\n"
+            "Пожалуйста, подождите."
+        )
+
+        if match:
+            # Отправляем уведомления обоим пользователям
+            await send_later(
+                chat_id=queued_user.telegram_id,
+                text=_NOTIFY_TMPL.format_map({'other_age': match.age, 'self_age': queued_user.age})
+            )
+            await send_later(
+                chat_id=match.telegram_id,
+                text=_NOTIFY_TMPL.format_map({'other_age': queued_user.age, 'self_age': match.age})
+            )
+        else:
+            await send_later(
+                chat_id=queued_user.telegram_id,
+                text="⏳ Собеседник пока не найден. Вы добавлены в очередь ожидания.\n"
+                     "Мы уведомим вас, когда найдем подходящего собеседника."
+            )
+
+    elif chat_ended:
+        if partner_telegram_id:
+            await send_later(
+                chat_id=partner_telegram_id,
+                text="❌ Собеседник завершил чат."
+            )
+        await query.edit_message_text("✅ Чат завершен.")
 
-async def show_chat_history(query, session, user: User, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает историю последних 3 чатов"""
-    from sqlalchemy import select, desc
 
+async def show_chat_history(query, session, user: CachedUser, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает историю последних 3 чатов"""
     # Получаем последние 3 чата из истории пользователя
-    result = await session.execute(
-        select(ChatHistory, Chat).join(Chat, ChatHistory.chat_id == Chat.id)  # type: ignore
-        .where(ChatHistory.user_id == user.id)  # type: ignore
-        .order_by(desc(ChatHistory.viewed_at))
-        .limit(3)
-    )
-    history_entries = result.all()
+    result = await session.execute(_Q_CHAT_HISTORY, {'user_id': user.id})
+    chats = result.scalars().all()
 
-    if not history_entries:
+    if not chats:
         await query.edit_message_text("📜 У вас пока нет истории чатов.")
         return
 
-    keyboard = []
-    for i, (history_entry, chat) in enumerate(history_entries, 1):
-        # Определяем собеседника
-        if chat.user1_id == user.id:
-            partner_id = chat.user2_id
-        else:
-            partner_id = chat.user1_id
+    # Определяем собеседников и загружаем их одним запросом
+    partner_ids = [
+        chat.user2_id if chat.user1_id == user.id else chat.user1_id
+        for chat in chats
+    ]
+    result = await session.execute(_Q_USERS_BY_IDS, {'user_ids': partner_ids})
+    partners = {partner.id: partner for partner in result.scalars()}
 
-        result = await session.execute(select(User).where(User.id == partner_id))  # type: ignore
-        partner = result.scalar_one_or_none()
+    keyboard = []
+    for i, (chat, partner_id) in enumerate(zip(chats, partner_ids), 1):
+        partner = partners.get(partner_id)
 
         if partner:
             keyboard.append([
@@ -659,7 +834,7 @@ async def show_chat_history(query, session, user: User, context: ContextTypes.DE
                 )
             ])
 
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+    keyboard.append([BACK_TO_MENU_BUTTON])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(
@@ -669,45 +844,165 @@ async def show_chat_history(query, session, user: User, context: ContextTypes.DE
     )
 
 
-async def view_chat_history(query, session, user: User, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+async def view_chat_history(query, session, user: CachedUser, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     """Показывает историю конкретного чата"""
-    from sqlalchemy import select
-
-    result = await session.execute(select(Chat).where(Chat.id == chat_id))
-    chat = result.scalar_one_or_none()
+    chat = await session.get(Chat, chat_id)
 
     if not chat:
         await query.edit_message_text("❌ Чат не найден.")
         return
 
-    # Получаем сообщения чата
-    result = await session.execute(
-        select(ChatMessage).where(ChatMessage.chat_id == chat_id).order_by(ChatMessage.sent_at)
-    )
-    messages = result.scalars().all()
+    # Получаем сообщения чата потоком, не загружая весь результат сразу
+    result = await session.stream_scalars(_Q_CHAT_MESSAGES, {'chat_id': chat_id})
+
+    # Формируем текст истории из частей
+    parts = ["📜 История чата:\n\n"]
+    own_id = user.id
+
+    async for message in result:
+        prefix = "Вы" if message.user_id == own_id else "Собеседник"
+        parts.append(f"{prefix}: {message.text}\n   ({message.sent_at.strftime('%Y-%m-%d %H:%M')})\n\n")
 
-    if not messages:
+    if len(parts) == 1:
         await query.edit_message_text("📜 В этом чате нет сообщений.")
         return
 
-    # Формируем текст истории
-    history_text = "📜 История чата:\n\n"
+    # Длинная история не помещается в одно сообщение Telegram
+    chunks = split_message(parts)
 
-    for message in messages:
-        is_own = message.user_id == user.id
-        prefix = "Вы" if is_own else "Собеседник"
-        history_text += f"{prefix}: {message.text}\n"
-        history_text += f"   ({message.sent_at.strftime('%Y-%m-%d %H:%M')})\n\n"
+    if len(chunks) == 1:
+        await query.edit_message_text(chunks[0], reply_markup=BACK_TO_HISTORY_KB)
+        return
 
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="chat_history")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(chunks[0])
+    for chunk in chunks[1:-1]:
+        await send_later(chat_id=query.message.chat_id, text=chunk)
+    await send_later(chat_id=query.message.chat_id, text=chunks[-1], reply_markup=BACK_TO_HISTORY_KB)
+
+
+def split_message(parts: list[str], limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    """
+    Собирает части текста в сообщения длиной не более limit символов.
+    Части разрываются, только если одна часть длиннее лимита.
+    """
+    chunks = []
+    current = []
+    size = 0
+
+    for part in parts:
+        if current and size + len(part) > limit:
+            chunks.append("".join(current))
+            current = []
+            size = 0
+
+        while len(part) > limit:
+            chunks.append(part[:limit])
+            part = part[limit:]
+
+        current.append(part)
+        size += len(part)
 
-    await query.edit_message_text(history_text, reply_markup=reply_markup)
+    if current:
+        chunks.append("".join(current))
+
+    return chunks
+
+
+async def run_match_cycle():
+    """Один проход подбора: создает чаты для всех подходящих пар из очереди"""
+    try:
+        # Сначала проверяем очередь через соединение только для чтения:
+        # в большинстве проходов пар нет, и пишущая транзакция не открывается
+        async with read_session() as read_only:
+            if not await has_queue_pair(read_only):
+                return
+
+        # Весь проход по очереди выполняется в одной транзакции
+        async with unit_of_work() as session:
+
+            # Убираем из очереди заблокированных и уже общающихся пользователей
+            await session.execute(_Q_PURGE_QUEUE)
+
+            # Пары выбираются одним запросом, затем каждая забирается из очереди
+            pairs = await select_queue_pairs(session, MATCHMAKING_BATCH_SIZE)
+            claimed = []
+            for user1_id, user2_id in pairs:
+                pair = await claim_queue_pair(session, user1_id, user2_id)
+                if pair:
+                    claimed.append(pair)
+
+            new_chats = []
+            if claimed:
+                # Загружаем всех подобранных пользователей одним запросом
+                result = await session.execute(
+                    _Q_USERS_BY_IDS, {'user_ids': [entry.user_id for pair in claimed for entry in pair]}
+                )
+                users = {user.id: user for user in result.scalars()}
+
+                for entry, partner_entry in claimed:
+                    user, match = users[entry.user_id], users[partner_entry.user_id]
+                    new_chats.append((user, match, entry.role, entry.problem_type))
+                    mark_user_stale(session, user.telegram_id, match.telegram_id)
+
+                # Создаем все чаты пакетными запросами
+                await create_chats_bulk(session, new_chats)
+
+        # Пар могло остаться больше, чем забирается за проход: продолжаем подбор
+        if len(pairs) >= MATCHMAKING_BATCH_SIZE:
+            matchmaking_signal.set()
+
+        # Уведомления отправляем после коммита, чтобы не держать транзакцию.
+        # Постановка в очереди идет параллельно: переполненная очередь одного
+        # отправителя не задерживает уведомления остальным
+        notifications = []
+        for user, match, _, _ in new_chats:
+            notifications.append(send_later(
+                chat_id=user.telegram_id,
+                text=_NOTIFY_TMPL.format_map({'other_age': match.age, 'self_age': user.age})
+            ))
+            notifications.append(send_later(
+                chat_id=match.telegram_id,
+                text=_NOTIFY_TMPL.format_map({'other_age': user.age, 'self_age': match.age})
+            ))
+
+        for result in await asyncio.gather(*notifications, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка отправки уведомления о подборе: {result}")
+
+    except Exception as e:
+        logger.error(f"Ошибка в фоновом подборе: {e}")
+
+
+async def matchmaker_loop():
+    """
+    Фоновый подбор собеседников: проход запускается, когда очередь изменилась,
+    и не реже раза в MATCHMAKING_WATCHDOG секунд на случай пропущенного сигнала
+    """
+    while True:
+        try:
+            await asyncio.wait_for(matchmaking_signal.wait(), timeout=MATCHMAKING_WATCHDOG)
+        except asyncio.TimeoutError:
+            pass
+        matchmaking_signal.clear()
+        await run_match_cycle()
+
+
+def start_matchmaker():
+    """Запускает фоновую задачу подбора собеседников"""
+    _matchmaker_tasks.append(asyncio.create_task(matchmaker_loop()))
+
+
+async def stop_matchmaker():
+    """Останавливает фоновую задачу подбора собеседников"""
+    for task in _matchmaker_tasks:
+        task.cancel()
+    await asyncio.gather(*_matchmaker_tasks, return_exceptions=True)
+    _matchmaker_tasks.clear()
 
 
 def main():
     """Главная функция запуска бота"""
-    if not BOT_TOKEN:
+    if not CONFIG.BOT_TOKEN:
         logger.error("BOT_TOKEN не установлен! Создайте файл .env с BOT_TOKEN=ваш_токен")
         return
 
@@ -716,8 +1011,26 @@ def main():
         """Инициализация базы данных после создания приложения"""
         await init_db()
         logger.info("База данных инициализирована")
-
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+        start_senders(application.bot)
+        start_writer()
+        start_matchmaker()
+
+    async def post_stop(application: Application) -> None:
+        """
+        Остановка фоновых задач подбора, записи и отправки сообщений.
+        Выполняется до закрытия соединения бота, чтобы оставшиеся сообщения успели уйти
+        """
+        await stop_matchmaker()
+        await stop_writer()
+        await stop_senders()
+
+    application = (
+        Application.builder()
+        .token(CONFIG.BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
 
     # Создаем ConversationHandler для регистрации
     conv_handler = ConversationHandler(
@@ -737,86 +1050,6 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CommandHandler("start", start))
 
-    # Функция для периодического подбора собеседников
-    async def periodic_matchmaking_task(context: ContextTypes.DEFAULT_TYPE):
-        try:
-            async with async_session() as session:
-                from sqlalchemy import select
-
-                # Получаем всех пользователей в очереди
-                result = await session.execute(select(QueueEntry))
-                queue_entries = result.scalars().all()
-
-                processed_users = set()
-
-                for queue_entry in queue_entries:
-                    if queue_entry.user_id in processed_users:
-                        continue
-
-                    result = await session.execute(select(User).where(User.id == queue_entry.user_id))  # type: ignore
-                    user = result.scalar_one_or_none()
-
-                    if not user or user.is_banned or user.current_chat_id:
-                        await remove_from_queue(session, queue_entry.user_id)
-                        continue
-
-                    # Ищем подходящего собеседника
-                    match = await find_match(session, user, queue_entry.role, queue_entry.problem_type)
-
-                    if match:
-                        # Проверяем, что собеседник еще не в чате
-                        result = await session.execute(select(User).where(User.id == match.id))  # type: ignore
-                        match_user = result.scalar_one_or_none()
-
-                        if match_user and not match_user.current_chat_id:
-                            # Создаем чат
-                            chat = await create_chat(session, user, match_user, queue_entry.role,
-                                                     queue_entry.problem_type)
-                            await session.commit()
-
-                            # Удаляем обоих из очереди
-                            await remove_from_queue(session, user.id)
-                            await remove_from_queue(session, match_user.id)
-                            processed_users.add(match_user.id)
-
-                            # Отправляем уведомления
-                            try:
-                                await context.bot.send_message(
-                                    chat_id=user.telegram_id,
-                                    text=f"✅ Собеседник найден!\n\n"
-                                         f"Возраст собеседника: {match_user.age} лет\n"
-                                         f"Ваш возраст виден собеседнику: {user.age} лет\n\n"
-                                         f"Начните общение!"
-                                )
-
-                                await context.bot.send_message(
-                                    chat_id=match_user.telegram_id,
-                                    text=f"✅ Собеседник найден!\n\n"
-                                         f"Возраст собеседника: {user.age} лет\n"
-                                         f"Ваш возраст виден собеседнику: {match_user.age} лет\n\n"
-                                         f"Начните общение!"
-                                )
-                            except Exception as e:
-                                logger.error(f"Ошибка отправки сообщения: {e}")
-
-                    processed_users.add(user.id)
-
-                await session.commit()
-
-        except Exception as e:
-            logger.error(f"Ошибка в периодическом подборе: {e}")
-
-    # Запускаем периодический подбор через job_queue (каждые 5 секунд)
-    if application.job_queue:
-        application.job_queue.run_repeating(
-            periodic_matchmaking_task,
-            interval=5,
-            first=5
-        )
-    else:
-        logger.warning("JobQueue не доступен. Периодический подбор собеседников не будет работать.")
-        logger.warning("Установите python-telegram-bot с job-queue: pip install 'python-telegram-bot[job-queue]'")
-
     # Запускаем бота
     logger.info("Бот запущен!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
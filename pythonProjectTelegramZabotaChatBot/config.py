@@ -1,14 +1,23 @@
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Токен бота из переменных окружения
-BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 
-# Настройки базы данных
-DATABASE_URL = 'sqlite+aiosqlite:///bot_database.db'
+@dataclass(frozen=True, slots=True)
+class _Config:
+    """Настройки бота: читаются один раз при импорте и дальше не меняются"""
 
-# Минимальный и максимальный возраст
-MIN_AGE = 14
-MAX_AGE = 18
\ No newline at end of file
+    # Токен бота из переменных окружения
+    BOT_TOKEN: str = os.getenv('BOT_TOKEN', '')
+
+    # Настройки базы данных
+    DATABASE_URL: str = 'sqlite+aiosqlite:///bot_database.db'
+
+    # Минимальный и максимальный возраст
+    MIN_AGE: int = 14
+    MAX_AGE: int = 18
+
+
+CONFIG = _Config()
\ No newline at end of file
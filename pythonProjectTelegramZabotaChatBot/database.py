@@ -1,102 +1,287 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
-from datetime import datetime
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, Boolean, DateTime, ForeignKey, Text, Index
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from enum import IntEnum
+
+from config import CONFIG
 
 Base = declarative_base()
 
 
+class Role(IntEnum):
+    """Роль пользователя в чате"""
+    SUPPORT = 1  # поддерживает собеседника
+    RECEIVE = 2  # получает поддержку
+
+    @property
+    def opposite(self) -> 'Role':
+        return Role.RECEIVE if self is Role.SUPPORT else Role.SUPPORT
+
+
+class Problem(IntEnum):
+    """Тема, с которой пользователь ищет собеседника"""
+    STRESS_ANXIETY = 1
+    STUDY = 2
+    FRIENDS = 3
+
+
+class IntEnumType(TypeDecorator):
+    """Хранит IntEnum в столбце SmallInteger и возвращает его обратно как член перечисления"""
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, enum_class):
+        super().__init__()
+        self.enum_class = enum_class
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(value)
+
+    def process_result_value(self, value, dialect):
+        # int() нужен для таблиц, созданных со столбцами TEXT
+        return None if value is None else self.enum_class(int(value))
+
+
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False, index=True)
+    # Идентификаторы Telegram не помещаются в 32 бита
+    telegram_id = Column(BigInteger, unique=True, nullable=False, index=True)
     age = Column(Integer, nullable=False)
     is_banned = Column(Boolean, default=False)
-    registered_at = Column(DateTime, default=datetime.utcnow)
-    current_chat_id = Column(Integer, ForeignKey('chats.id'), nullable=True)
-    current_role = Column(String, nullable=True)  # support или receive_support
-    current_problem = Column(String, nullable=True)  # stress или anxiety
+    registered_at = Column(DateTime, server_default=func.current_timestamp())
+    current_chat_id = Column(Integer, ForeignKey('chats.id', ondelete='SET NULL'), nullable=True)
+    # telegram_id собеседника в текущем чате: пересылка сообщений без загрузки чата
+    partner_telegram_id = Column(BigInteger, nullable=True)
+    current_role = Column(IntEnumType(Role), nullable=True)
+    current_problem = Column(IntEnumType(Problem), nullable=True)
 
-    # Связи
-    chats = relationship("Chat", foreign_keys="Chat.user1_id", back_populates="user1")
-    chats2 = relationship("Chat", foreign_keys="Chat.user2_id", back_populates="user2")
-    messages = relationship("Message", back_populates="user")
-    chat_history = relationship("ChatHistory", back_populates="user")
+    # Связи (коллекции загружаются только явно, через selectinload в запросе).
+    # Зависимые строки при удалении пользователя удаляет сама база (ON DELETE CASCADE)
+    chats = relationship(
+        "Chat", foreign_keys="Chat.user1_id", back_populates="user1", lazy="raise_on_sql", passive_deletes=True
+    )
+    chats2 = relationship(
+        "Chat", foreign_keys="Chat.user2_id", back_populates="user2", lazy="raise_on_sql", passive_deletes=True
+    )
+    messages = relationship("Message", back_populates="user", lazy="raise_on_sql", passive_deletes=True)
 
 
 class Chat(Base):
     __tablename__ = 'chats'
+    __table_args__ = (
+        # История: последние завершенные чаты пользователя в любой из двух ролей
+        Index('ix_chat_user1_ended', 'user1_id', 'ended_at'),
+        Index('ix_chat_user2_ended', 'user2_id', 'ended_at'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user1_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    user2_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    role1 = Column(String, nullable=False)  # support или receive_support
-    role2 = Column(String, nullable=False)
-    problem_type = Column(String, nullable=False)  # stress или anxiety
-    created_at = Column(DateTime, default=datetime.utcnow)
+    user1_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    user2_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    role1 = Column(IntEnumType(Role), nullable=False)
+    role2 = Column(IntEnumType(Role), nullable=False)
+    problem_type = Column(IntEnumType(Problem), nullable=False)
+    created_at = Column(DateTime, server_default=func.current_timestamp())
     is_active = Column(Boolean, default=True)
     ended_at = Column(DateTime, nullable=True)
 
     # Связи
     user1 = relationship("User", foreign_keys=[user1_id], back_populates="chats")
     user2 = relationship("User", foreign_keys=[user2_id], back_populates="chats2")
-    messages = relationship("Message", back_populates="chat")
+    messages = relationship("Message", back_populates="chat", lazy="raise_on_sql", passive_deletes=True)
 
 
 class Message(Base):
     __tablename__ = 'messages'
+    # История чата: сообщения одного чата в порядке отправки
+    __table_args__ = (Index('ix_msg_chat_sent', 'chat_id', 'sent_at'),)
 
     id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer, ForeignKey('chats.id'), nullable=False)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    chat_id = Column(Integer, ForeignKey('chats.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     text = Column(Text, nullable=False)
-    sent_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, server_default=func.current_timestamp())
 
     # Связи
     chat = relationship("Chat", back_populates="messages")
     user = relationship("User", back_populates="messages")
 
 
-class ChatHistory(Base):
-    __tablename__ = 'chat_history'
-
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    chat_id = Column(Integer, ForeignKey('chats.id'), nullable=False)
-    viewed_at = Column(DateTime, default=datetime.utcnow)
-
-    # Связи
-    user = relationship("User", back_populates="chat_history")
-    chat = relationship("Chat")
-
-
 class QueueEntry(Base):
     __tablename__ = 'queue_entries'
+    # Поиск собеседника: равенство по проблеме и роли, диапазон по возрасту
+    __table_args__ = (Index('ix_queue_match', 'problem_type', 'role', 'age'),)
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), unique=True, nullable=False)
-    role = Column(String, nullable=False)  # support или receive_support
-    problem_type = Column(String, nullable=False)  # stress или anxiety
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), unique=True, nullable=False)
+    role = Column(IntEnumType(Role), nullable=False)
+    problem_type = Column(IntEnumType(Problem), nullable=False)
     age = Column(Integer, nullable=False)
-    joined_at = Column(DateTime, default=datetime.utcnow)
+    joined_at = Column(DateTime, server_default=func.current_timestamp())
 
     # Связи
-    user = relationship("User")
+    user = relationship("User", lazy="selectin")
 
 
 # Создание движка и сессии
-engine = create_async_engine('sqlite+aiosqlite:///bot_database.db', echo=False)
-async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Для aiosqlite по умолчанию используется NullPool (новое соединение на каждую сессию),
+# поэтому пул соединений задаем явно. Запись в SQLite все равно идет по одной,
+# так что большой пул не нужен; соединения не пересоздаются, чтобы сохранять их кэш страниц
+_ENGINE_OPTIONS = dict(
+    echo=False,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=5,
+    max_overflow=5,
+    pool_pre_ping=False,
+    pool_recycle=-1,
+    query_cache_size=1200,
+    # Сколько секунд ждать снятия блокировки базы другим соединением (busy_timeout)
+    connect_args={'timeout': 30},
+)
+
+_database_url = make_url(CONFIG.DATABASE_URL)
+engine = create_async_engine(_database_url, **_ENGINE_OPTIONS)
+# autoflush отключен: запросы не сбрасывают изменения из сессии перед выполнением.
+# Если запросу нужны еще не записанные объекты, вызывайте session.flush() явно
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+# Отдельный движок только для чтения (просмотр очереди при подборе):
+# в режиме WAL его запросы не ждут пишущие соединения
+# (та же база, открытая как URI с mode=ro)
+read_engine = create_async_engine(
+    _database_url.set(database=f'file:{_database_url.database}', query={'mode': 'ro', 'uri': 'true'}),
+    **_ENGINE_OPTIONS
+)
+read_session = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+# Настройки SQLite, применяемые один раз при открытии соединения:
+# WAL не блокирует чтение во время записи, synchronous=NORMAL убирает fsync на каждом коммите
+_SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA foreign_keys=ON',
+)
+
+
+# Режим журнала задается пишущим соединением, для чтения нужны только настройки кэша
+_SQLITE_READ_PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',
+    'PRAGMA mmap_size=268435456',
+)
+
+
+def _execute_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@event.listens_for(engine.sync_engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    _execute_pragmas(dbapi_connection, _SQLITE_PRAGMAS)
+
+
+@event.listens_for(read_engine.sync_engine, 'connect')
+def _set_sqlite_read_pragmas(dbapi_connection, connection_record):
+    _execute_pragmas(dbapi_connection, _SQLITE_READ_PRAGMAS)
+
+
+def _create_missing_indexes(conn):
+    """Создает индексы, которых нет в уже существующих таблицах"""
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _add_missing_columns(conn):
+    """Добавляет в существующие таблицы новые столбцы (все они допускают NULL)"""
+    inspector = inspect(conn)
+    for table in Base.metadata.tables.values():
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+# Строковые значения ролей и проблем, которые хранились до перехода на IntEnum
+_LEGACY_ENUM_VALUES = {
+    'support': Role.SUPPORT,
+    'receive': Role.RECEIVE,
+    'receive_support': Role.RECEIVE,
+    'stress_anxiety': Problem.STRESS_ANXIETY,
+    'stress': Problem.STRESS_ANXIETY,
+    'anxiety': Problem.STRESS_ANXIETY,
+    'study': Problem.STUDY,
+    'friends': Problem.FRIENDS,
+}
+_ENUM_COLUMNS = (
+    ('users', 'current_role'),
+    ('users', 'current_problem'),
+    ('chats', 'role1'),
+    ('chats', 'role2'),
+    ('chats', 'problem_type'),
+    ('queue_entries', 'role'),
+    ('queue_entries', 'problem_type'),
+)
+
+
+def _convert_legacy_enum_values(conn):
+    """Заменяет строковые роли и проблемы числовыми значениями перечислений"""
+    for table, column in _ENUM_COLUMNS:
+        # В столбцах TEXT уже преобразованные числа тоже хранятся как текст,
+        # поэтому старыми считаются только нечисловые строки
+        has_legacy = conn.execute(text(
+            f"SELECT 1 FROM {table} WHERE typeof({column}) = 'text' AND {column} NOT GLOB '[0-9]*' LIMIT 1"
+        )).first()
+        if has_legacy is None:
+            continue
+        for old, new in _LEGACY_ENUM_VALUES.items():
+            conn.execute(text(f'UPDATE {table} SET {column} = :new WHERE {column} = :old'), {'new': int(new), 'old': old})
 
 
 async def init_db():
     """Инициализация базы данных"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all не изменяет таблицы, созданные ранее
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+        await conn.run_sync(_convert_legacy_enum_values)
+
+        # История чатов строится по таблице chats, отдельная таблица больше не нужна
+        await conn.execute(text('DROP TABLE IF EXISTS chat_history'))
+        # Ни один запрос не фильтрует чаты по is_active, индекс только замедлял запись
+        await conn.execute(text('DROP INDEX IF EXISTS ix_chat_active_users'))
+
+        # Заполняем собеседника для чатов, начатых до появления partner_telegram_id
+        await conn.execute(text(
+            'UPDATE users SET partner_telegram_id = ('
+            '    SELECT partner.telegram_id FROM chats'
+            '    JOIN users AS partner ON partner.id = CASE WHEN chats.user1_id = users.id'
+            '        THEN chats.user2_id ELSE chats.user1_id END'
+            '    WHERE chats.id = users.current_chat_id'
+            ') WHERE current_chat_id IS NOT NULL AND partner_telegram_id IS NULL'
+        ))
 
 
 async def get_session():
-    """Получение сессии базы данных"""
+    """
+    Получение сессии базы данных.
+    Соединение берется из пула при первом запросе сессии и возвращается при ее закрытии.
+    Для запросов, которые только читают данные, используйте read_session
+    (открывать его можно только после init_db, когда файл базы уже создан).
+    """
     async with async_session() as session:
         yield session
\ No newline at end of file
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает бота примерно 30 исходящими сообщениями в секунду
+SEND_RATE = 30
+# Количество параллельных отправителей и размер очереди каждого из них
+SEND_WORKERS = 8
+SEND_QUEUE_SIZE = 1000
+# Сколько секунд при остановке ждать отправки сообщений, оставшихся в очередях
+SEND_DRAIN_TIMEOUT = 30
+# Сколько раз повторять отправку при сетевой ошибке и пауза между попытками (в секундах)
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 1
+
+
+class TokenBucket:
+    """Ограничитель частоты: не более rate операций в секунду, допускает всплески до capacity"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу токенов всем отправителям (ответ Telegram RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждет, пока не освободится токен, и забирает его"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_send_queues: list[asyncio.Queue] = []
+_sender_tasks: list[asyncio.Task] = []
+
+
+async def send_later(chat_id: int, text: str, **kwargs):
+    """
+    Ставит сообщение в очередь отправки и сразу возвращает управление.
+    Ждет только при переполненной очереди. Сообщения одному получателю
+    отправляются в порядке постановки в очередь.
+    """
+    queue = _send_queues[chat_id % len(_send_queues)]
+    await queue.put({'chat_id': chat_id, 'text': text, **kwargs})
+
+
+async def _sender(bot, queue: asyncio.Queue, bucket: TokenBucket):
+    """Отправляет сообщения из очереди с учетом общего ограничения частоты"""
+    while True:
+        message = await queue.get()
+        try:
+            await _send(bot, message, bucket)
+        finally:
+            queue.task_done()
+
+
+async def _send(bot, message: dict, bucket: TokenBucket):
+    """
+    Отправляет одно сообщение. При ограничении частоты (RetryAfter) ждет указанное
+    Telegram время и повторяет отправку, при сетевой ошибке повторяет до SEND_RETRIES раз.
+    Сообщение теряется только при постоянной ошибке (бот заблокирован, неверный запрос)
+    """
+    retries = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await bot.send_message(**message)
+            return
+        except RetryAfter as e:
+            logger.warning(f"Ограничение частоты Telegram, повтор через {e.retry_after} с")
+            bucket.pause(e.retry_after)
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Сообщение пользователю {message['chat_id']} не отправлено: {e}")
+            return
+        except NetworkError as e:
+            retries += 1
+            if retries > SEND_RETRIES:
+                logger.error(f"Сообщение пользователю {message['chat_id']} не отправлено: {e}")
+                return
+            await asyncio.sleep(SEND_RETRY_DELAY)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения: {e}")
+            return
+
+
+def start_senders(bot):
+    """Запускает фоновые задачи отправки сообщений"""
+    bucket = TokenBucket(rate=SEND_RATE, capacity=SEND_RATE)
+    for _ in range(SEND_WORKERS):
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        _send_queues.append(queue)
+        _sender_tasks.append(asyncio.create_task(_sender(bot, queue, bucket)))
+
+
+async def stop_senders(timeout: float = SEND_DRAIN_TIMEOUT):
+    """
+    Отправляет сообщения, оставшиеся в очередях, и останавливает фоновые задачи.
+    Если за timeout секунд очереди не опустели, остаток теряется (с записью в лог).
+    """
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in _send_queues)), timeout)
+    except asyncio.TimeoutError:
+        left = sum(queue.qsize() for queue in _send_queues)
+        logger.error(f"Не отправлено сообщений при остановке: {left}")
+
+    for task in _sender_tasks:
+        task.cancel()
+    await asyncio.gather(*_sender_tasks, return_exceptions=True)
+    _sender_tasks.clear()
+    _send_queues.clear()
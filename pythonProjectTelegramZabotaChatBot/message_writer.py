@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert
+
+from database import async_session, Message
+
+logger = logging.getLogger(__name__)
+
+# Сообщения пишутся в базу пачками: не больше WRITE_BATCH_SIZE строк
+# и не дольше WRITE_DELAY секунд ожидания после первого сообщения пачки
+WRITE_BATCH_SIZE = 500
+WRITE_DELAY = 0.05
+WRITE_QUEUE_SIZE = 10000
+
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+
+async def save_message_later(chat_id: int, user_id: int, text: str, sent_at: datetime):
+    """
+    Ставит сообщение чата в очередь записи и сразу возвращает управление.
+    Ждет только при переполненной очереди. Порядок сообщений сохраняется.
+    """
+    if _write_queue is None:
+        raise RuntimeError("Фоновая запись сообщений не запущена: вызовите start_writer()")
+    await _write_queue.put({'chat_id': chat_id, 'user_id': user_id, 'text': text, 'sent_at': sent_at})
+
+
+async def _write_batch(batch: list[dict]):
+    """Записывает пачку сообщений одним INSERT (executemany) и одним коммитом"""
+    async with async_session() as session:
+        await session.execute(insert(Message), batch)
+        await session.commit()
+
+
+async def _writer(queue: asyncio.Queue):
+    """Собирает сообщения из очереди в пачки и записывает их в базу"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + WRITE_DELAY
+
+        while len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            await _write_batch(batch)
+        except Exception as e:
+            logger.error(f"Ошибка записи сообщений ({len(batch)} шт.): {e}")
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+def start_writer():
+    """Запускает фоновую запись сообщений"""
+    global _write_queue, _writer_task
+    _write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    _writer_task = asyncio.create_task(_writer(_write_queue))
+
+
+async def stop_writer():
+    """Дописывает сообщения, оставшиеся в очереди, и останавливает фоновую запись"""
+    global _write_queue, _writer_task
+    if _writer_task is None:
+        return
+    await _write_queue.join()
+    _writer_task.cancel()
+    await asyncio.gather(_writer_task, return_exceptions=True)
+    _write_queue = _writer_task = None
@@ -1,3 +1,6 @@
+import re
+from functools import lru_cache
+
 # Список ненормативной лексики и бранных слов для фильтрации
 
 PROFANITY_WORDS = [
@@ -30,6 +33,18 @@ PROFANITY_WORDS = [
 ]
 
 
+# Множество для быстрого поиска целых слов
+PROFANITY_SET = frozenset(PROFANITY_WORDS)
+
+# Одно регулярное выражение для всех слов. Слово должно совпадать целиком:
+# до и после него не может быть буквы или цифры (как при разбиении по пробелам)
+_PROFANITY_RE = re.compile(
+    r'(?<![а-яёa-z0-9])(?:'
+    + '|'.join(re.escape(word) for word in sorted(PROFANITY_SET, key=len, reverse=True))
+    + r')(?![а-яёa-z0-9])'
+)
+
+
 def check_profanity(text: str) -> bool:
     """
     Проверяет текст на наличие ненормативной лексики.
@@ -41,28 +56,15 @@ def check_profanity(text: str) -> bool:
     if not text:
         return False
 
-    import re
+    return _check_lowered(text.lower())
 
-    # Приводим текст к нижнему регистру
-    text_lower = text.lower()
-
-    # Создаем set для быстрого поиска
-    profanity_set = set(PROFANITY_WORDS)
-
-    # Заменяем все знаки препинания и специальные символы на пробелы
-    # Это позволяет корректно разделять слова (используем явный паттерн для кириллицы и латиницы)
-    text_normalized = re.sub(r'[^а-яёa-z0-9\s]', ' ', text_lower)
-
-    # Разделяем на слова по пробелам и фильтруем пустые строки
-    words = [word for word in text_normalized.split() if word]
 
+@lru_cache(maxsize=4096)
+def _check_lowered(text_lower: str) -> bool:
+    """Проверка текста в нижнем регистре; результат кэшируется для повторяющихся сообщений"""
     # Проверяем только точные совпадения целых слов
     # Это гарантирует, что подстроки внутри обычных слов не будут заблокированы
-    for word in words:
-        if word in profanity_set:
-            return True
-
-    return False
+    return _PROFANITY_RE.search(text_lower) is not None
 
 
 # Тестирование функции